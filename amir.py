@@ -9,16 +9,25 @@ Features:
 - Admin-only commands
 """
 
+import asyncio
+import csv
+import io
 import logging
 import os
 import re
 import sqlite3
-import hmac
+import ssl
+import tempfile
 import hashlib
-from datetime import datetime
+import threading
+import time
+import functools
+import itertools
+import math
 from typing import Optional
 
-import pandas as pd
+import numpy as np
+from openpyxl import load_workbook
 from telegram import Update
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
 
@@ -26,112 +35,405 @@ from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, Messa
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN_HERE")
 HMAC_SECRET = os.environ.get("HMAC_SECRET", "replace-with-a-long-random-secret")
 DB_PATH = os.environ.get("DB_PATH", "scores.db")
-ADMINS = set(int(x) for x in os.environ.get("ADMINS", "").split(',') if x.strip().isdigit())
+# when set (e.g. https://<service>.onrender.com), serve updates over a webhook on
+# PORT from the bot's own event loop instead of long polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip('/')
+# required with WEBHOOK_URL: Telegram echoes it in every webhook request and PTB
+# rejects requests without it, so nobody else can POST forged updates
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+PORT = int(os.environ.get("PORT", "8443"))
+ADMINS = frozenset(int(x) for x in os.environ.get("ADMINS", "").split(',') if x.strip().isdigit())
+
+_MAC_KEY = HMAC_SECRET.encode('utf-8')
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-NATIONAL_CODE_RE = re.compile(r"^\d{10}$")
-SPLIT_RE = re.compile(r"[|:\s]+")
+# '|' and ':' separate fields just like whitespace; map them to spaces and let
+# str.split() do the rest (no regex, and empty parts are dropped for free)
+_DELIM_TRANS = str.maketrans('|:', '  ')
+# a user message: national code (ASCII/Persian/Arabic-Indic digits), optionally followed by a subject
+_MSG_RE = re.compile(r"[|:\s]*([0-9۰-۹٠-٩]{10})(?:[|:\s]+(.*))?", re.S)
+# Persian (U+06F0..) and Arabic-Indic (U+0660..) digits; both are common on Iranian keyboards
+_FA_TO_EN = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
 
 # ---------------- Persian number helper ----------------
 def persian_to_english_number(text: str) -> str:
-    persian_numbers = '۰۱۲۳۴۵۶۷۸۹'
-    english_numbers = '0123456789'
-    return text.translate(str.maketrans(persian_numbers, english_numbers))
+    # most clients send ASCII digits; isascii() is a quick scan and skips the copy
+    return text if text.isascii() else text.translate(_FA_TO_EN)
+
+def split_parts(text: str) -> list:
+    return text.translate(_DELIM_TRANS).split()
 
 # ---------------- DB ----------------
+_tls = threading.local()
+
 def get_conn():
-    conn = sqlite3.connect(DB_PATH, isolation_level=None)
-    conn.execute("PRAGMA foreign_keys = ON")
+    # one long-lived connection per thread (the event loop's to_thread workers);
+    # opening a handle per query costs far more than the queries themselves, and
+    # separate connections let WAL readers run alongside a writer. The SQL below
+    # lives in module constants, so hot statements stay in the statement cache.
+    conn = getattr(_tls, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, isolation_level=None, cached_statements=256)
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA mmap_size = 268435456")
+        conn.execute("PRAGMA cache_size = -20000")
+        _tls.conn = conn
     return conn
 
+# PRAGMA user_version; 1 = code_hmac stored as BLOB
+_SCHEMA_VERSION = 1
+
 def init_db():
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
+    # WAL is persistent in the database file, so it is set once here; the
+    # remaining PRAGMAs in get_conn() are per-connection
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("""
     CREATE TABLE IF NOT EXISTS scores (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        code_hmac TEXT NOT NULL,
+        code_hmac BLOB NOT NULL,
         subject TEXT NOT NULL,
         score REAL NOT NULL,
         updated_at TEXT NOT NULL,
         UNIQUE(code_hmac, subject)
     );
     """)
-    conn.commit()
-    conn.close()
+    # lets lookup_scores answer WHERE code_hmac=? ORDER BY subject from the index
+    # alone, without touching the table rows
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scores_covering ON scores(code_hmac, subject, score, updated_at)")
+    # databases created before code_hmac became a raw 32-byte digest hold hex text;
+    # the scan is unindexed, so it runs once and user_version records that it did
+    if conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            legacy = conn.execute("SELECT id, code_hmac FROM scores WHERE typeof(code_hmac) = 'text'").fetchall()
+            conn.executemany("UPDATE scores SET code_hmac=? WHERE id=?", [(bytes.fromhex(h), i) for i, h in legacy])
+            conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    conn.execute("PRAGMA analysis_limit = 1000")
+    conn.execute("ANALYZE")
 
 # ---------------- security ----------------
-def hmac_code(code: str) -> str:
-    return hmac.new(HMAC_SECRET.encode(), code.encode(), hashlib.sha256).hexdigest()
+def _hmac_pads(key: bytes):
+    # HMAC key schedule (RFC 2104), done once: SHA-256 states already fed the
+    # ipad/opad blocks, so each code only costs two copy()s and two tiny updates.
+    # That is ~2x faster than hmac.digest, which redoes the key setup per call.
+    if len(key) > 64:
+        key = hashlib.sha256(key).digest()
+    key = key.ljust(64, b'\0')
+    return hashlib.sha256(bytes(b ^ 0x36 for b in key)), hashlib.sha256(bytes(b ^ 0x5c for b in key))
+
+_HMAC_INNER, _HMAC_OUTER = _hmac_pads(_MAC_KEY)
+
+def _hmac_sha256(code: str) -> bytes:
+    inner = _HMAC_INNER.copy()
+    inner.update(code.encode('ascii'))
+    outer = _HMAC_OUTER.copy()
+    outer.update(inner.digest())
+    return outer.digest()
+
+hmac_code = functools.lru_cache(maxsize=4096)(_hmac_sha256)
+
+def hmac_codes_batch(codes) -> list:
+    """Hash many codes at once; bypasses the LRU so bulk imports don't evict hot users."""
+    return list(map(_hmac_sha256, codes))
+
+def sha256_backend() -> str:
+    # hashlib.sha256 is OpenSSL's unless Python was built without it; OpenSSL >= 1.1.1
+    # picks its SHA-NI / ARMv8 SHA-256 kernels at runtime when the CPU has them
+    if type(hashlib.sha256()).__module__ == '_hashlib':
+        return ssl.OPENSSL_VERSION
+    return "builtin _sha256 (Python built without OpenSSL; no SHA extensions)"
 
 def valid_iranian_national_code(code: str) -> bool:
-    if not NATIONAL_CODE_RE.match(code): return False
-    if len(set(code)) == 1: return False
-    digits = list(map(int, code))
-    s = sum(digits[i]*(10-i) for i in range(9))
-    r = s % 11
-    return digits[9]==r if r<2 else digits[9]==11-r
+    if len(code) != 10 or not code.isascii() or not code.isdigit(): return False
+    return _checksum_ok(code)
+
+def _checksum_ok(code: str) -> bool:
+    # caller guarantees exactly 10 ASCII digits
+    if code == code[0] * 10: return False
+    b = code.encode('ascii')
+    # weighted sum straight off the ASCII bytes; 2592 == 48 * (10+9+...+2)
+    r = (10*b[0] + 9*b[1] + 8*b[2] + 7*b[3] + 6*b[4] + 5*b[5] + 4*b[6] + 3*b[7] + 2*b[8] - 2592) % 11
+    return b[9] - 48 == (r if r < 2 else 11 - r)
+
+_CHECKSUM_WEIGHTS = np.arange(10, 1, -1)
+
+def valid_iranian_national_codes(codes: list) -> np.ndarray:
+    """Vectorized valid_iranian_national_code; returns a boolean mask."""
+    mask = np.fromiter((len(c) == 10 and c.isascii() and c.isdigit() for c in codes), dtype=bool, count=len(codes))
+    d = np.frombuffer(''.join(itertools.compress(codes, mask)).encode('ascii'), dtype=np.uint8).reshape(-1, 10) - ord('0')
+    r = (d[:, :9] @ _CHECKSUM_WEIGHTS) % 11
+    ok = np.where(r < 2, d[:, 9] == r, d[:, 9] == 11 - r) & (d.min(axis=1) != d.max(axis=1))
+    mask[mask] = ok
+    return mask
 
 # ---------------- data ops ----------------
-def add_or_update_score(code: str, subject: str, score: float):
+_SQL_UPSERT = (
+    # SQLite stamps updated_at itself (UTC), so callers never format a datetime per row
+    "INSERT INTO scores (code_hmac, subject, score, updated_at) VALUES (?, ?, ?, strftime('%Y-%m-%dT%H:%M:%f', 'now'))"
+    " ON CONFLICT(code_hmac, subject) DO UPDATE SET score=excluded.score, updated_at=excluded.updated_at"
+)
+_SQL_DEL_ONE = "DELETE FROM scores WHERE code_hmac=? AND subject=?"
+_SQL_DEL_ALL = "DELETE FROM scores WHERE code_hmac=?"
+_SQL_SEL_ALL = "SELECT subject, score, updated_at FROM scores WHERE code_hmac=? ORDER BY subject"
+_SQL_LIST_CODES = "SELECT DISTINCT code_hmac FROM scores LIMIT 200"
+
+# students tend to resend their code (or code + subject) right after a lookup;
+# keep each code's rows for a short while and drop them on any write
+_LOOKUP_TTL = 30
+_LOOKUP_CACHE_SIZE = 2048
+_LOOKUP_CACHE = {}  # code_hmac -> (expires_at, rows)
+_CACHE_LOCK = threading.Lock()
+# bumped on every write so a lookup that raced a write doesn't cache stale rows
+_cache_gen = 0
+
+def _invalidate_lookups(code_hs):
+    global _cache_gen
+    with _CACHE_LOCK:
+        _cache_gen += 1
+        for code_h in code_hs:
+            _LOOKUP_CACHE.pop(code_h, None)
+
+def _add_or_update_score_sync(code: str, subject: str, score: float):
     code_h = hmac_code(code)
     subj = subject.strip().lower()
-    now = datetime.utcnow().isoformat()
+    get_conn().execute(_SQL_UPSERT, (code_h, subj, score))
+    _invalidate_lookups((code_h,))
+
+def _add_or_update_scores_many_sync(triples) -> int:
+    """Upsert (code, subject, score) triples in a single transaction."""
+    triples = list(triples)
+    hashes = hmac_codes_batch([t[0] for t in triples])
+    rows = [(h, subject.strip().lower(), score) for h, (_, subject, score) in zip(hashes, triples)]
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO scores (code_hmac, subject, score, updated_at) VALUES (?, ?, ?, ?)"
-        " ON CONFLICT(code_hmac, subject) DO UPDATE SET score=excluded.score, updated_at=excluded.updated_at",
-        (code_h, subj, score, now)
-    )
-    conn.commit()
-    conn.close()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(_SQL_UPSERT, rows)
+        conn.execute("COMMIT")
+    except Exception:
+        # a failed COMMIT can leave the transaction open; this thread's connection
+        # must not carry it into the next statement
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    _invalidate_lookups(set(hashes))
+    return len(rows)
 
-def remove_score(code: str, subject: str) -> bool:
+def _remove_score_sync(code: str, subject: str) -> bool:
     code_h = hmac_code(code)
     subj = subject.strip().lower()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM scores WHERE code_hmac=? AND subject=?", (code_h, subj))
-    changed = cur.rowcount
-    conn.commit()
-    conn.close()
+    changed = get_conn().execute(_SQL_DEL_ONE, (code_h, subj)).rowcount
+    _invalidate_lookups((code_h,))
     return changed > 0
 
-def remove_all_scores(code: str) -> int:
+def _remove_all_scores_sync(code: str) -> int:
     code_h = hmac_code(code)
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM scores WHERE code_hmac=?", (code_h,))
-    removed = cur.rowcount
-    conn.commit()
-    conn.close()
+    removed = get_conn().execute(_SQL_DEL_ALL, (code_h,)).rowcount
+    _invalidate_lookups((code_h,))
     return removed
 
-def lookup_scores(code: str):
+def _lookup_scores_sync(code: str):
     code_h = hmac_code(code)
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT subject, score, updated_at FROM scores WHERE code_hmac=? ORDER BY subject", (code_h,))
-    rows = cur.fetchall()
-    conn.close()
+    now = time.monotonic()
+    with _CACHE_LOCK:
+        hit = _LOOKUP_CACHE.get(code_h)
+        if hit and hit[0] > now:
+            return hit[1]
+        gen = _cache_gen
+    rows = get_conn().execute(_SQL_SEL_ALL, (code_h,)).fetchall()
+    with _CACHE_LOCK:
+        if gen == _cache_gen:
+            # constant TTL, so insertion order is expiry order
+            _LOOKUP_CACHE.pop(code_h, None)
+            if len(_LOOKUP_CACHE) >= _LOOKUP_CACHE_SIZE:
+                del _LOOKUP_CACHE[next(iter(_LOOKUP_CACHE))]
+            _LOOKUP_CACHE[code_h] = (now + _LOOKUP_TTL, rows)
     return rows
 
-def lookup_subject(code: str, subject: str) -> Optional[tuple]:
-    code_h = hmac_code(code)
+def _lookup_subject_sync(code: str, subject: str) -> Optional[tuple]:
     subj = subject.strip().lower()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT subject, score, updated_at FROM scores WHERE code_hmac=? AND subject=?", (code_h, subj))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return next((r for r in _lookup_scores_sync(code) if r[0] == subj), None)
+
+def _list_codes_sync():
+    return get_conn().execute(_SQL_LIST_CODES).fetchall()
+
+# sqlite3 blocks; run every op on a worker thread so one slow write (or a big
+# import) doesn't stall the event loop, and with concurrent_updates (see main())
+# the other chats' updates keep being handled meanwhile
+async def add_or_update_score(code: str, subject: str, score: float):
+    if _write_q is None or _writer_task.done():
+        await asyncio.to_thread(_add_or_update_score_sync, code, subject, score)
+        return
+    done = asyncio.get_running_loop().create_future()
+    await _write_q.put((code, subject, score, done))
+    await done
+
+async def remove_score(code: str, subject: str) -> bool:
+    return await asyncio.to_thread(_remove_score_sync, code, subject)
+
+async def remove_all_scores(code: str) -> int:
+    return await asyncio.to_thread(_remove_all_scores_sync, code)
+
+async def lookup_scores(code: str):
+    return await asyncio.to_thread(_lookup_scores_sync, code)
+
+async def lookup_subject(code: str, subject: str) -> Optional[tuple]:
+    return await asyncio.to_thread(_lookup_subject_sync, code, subject)
+
+async def list_codes():
+    return await asyncio.to_thread(_list_codes_sync)
+
+# ---------------- write coalescing ----------------
+# with concurrent_updates, /add calls from several admins queue up here and one
+# writer task commits whatever has piled up as a single transaction; each caller
+# still waits until its row is committed
+_write_q: Optional[asyncio.Queue] = None
+_writer_task: Optional[asyncio.Task] = None
+
+def _settle(done: asyncio.Future, exc: Optional[BaseException] = None):
+    if done.done():  # caller went away (e.g. handler cancelled)
+        return
+    if exc is None:
+        done.set_result(None)
+    else:
+        done.set_exception(exc)
+
+async def _write_batch(batch):
+    try:
+        await asyncio.to_thread(_add_or_update_scores_many_sync, [item[:3] for item in batch])
+    except Exception as e:
+        if len(batch) == 1:
+            logger.exception("writing queued score failed")
+            _settle(batch[0][3], e)
+            return
+        # one bad row must not fail the other callers' writes: redo them one
+        # at a time so only the offending caller gets the exception
+        for *row, done in batch:
+            try:
+                await asyncio.to_thread(_add_or_update_score_sync, *row)
+            except Exception as e:
+                logger.exception("writing queued score failed")
+                _settle(done, e)
+            else:
+                _settle(done)
+    else:
+        logger.debug("committed %d queued scores", len(batch))
+        for *_, done in batch:
+            _settle(done)
+
+async def _score_writer(q: asyncio.Queue):
+    while True:
+        batch = [await q.get()]
+        while not q.empty():
+            batch.append(q.get_nowait())
+        # stop_score_writer's None is always the last item ever queued
+        stop = batch[-1] is None
+        if stop:
+            batch.pop()
+        try:
+            if batch:
+                await _write_batch(batch)
+        finally:
+            # only does anything if we were cancelled mid-batch; fail those
+            # callers instead of leaving them waiting forever
+            for *_, done in batch:
+                done.cancel()
+        if stop:
+            return
+
+async def start_score_writer(app):
+    # runs as the Application's post_init, i.e. on the loop that serves updates
+    global _write_q, _writer_task
+    _write_q = asyncio.Queue()
+    _writer_task = asyncio.create_task(_score_writer(_write_q))
+
+async def stop_score_writer(app):
+    # post_shutdown: flush whatever is still queued; later writes go direct
+    global _write_q, _writer_task
+    if _writer_task is None:
+        return
+    q, task = _write_q, _writer_task
+    _write_q = _writer_task = None
+    q.put_nowait(None)
+    await task
+
+# ---------------- file import ----------------
+_IMPORT_COLUMNS = ['code', 'subject', 'score']
+# uploads up to this size are parsed from a BytesIO; larger (or unknown-size) ones go
+# through a real temp file. Not SpooledTemporaryFile: before 3.11 it lacks the
+# readable()/seekable() that TextIOWrapper and zipfile need
+_IMPORT_MAX_IN_MEMORY = 5 << 20
+
+def _cell_str(value) -> str:
+    # Excel hands back numbers; 12345679.0 must read as the code 12345679
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return "" if value is None else str(value)
+
+def read_scores_file(source, file_name: str):
+    """Yield (code, subject, score) cell values from an uploaded .csv or .xlsx file."""
+    # the file is parsed lazily (csv module / openpyxl read-only mode) and only the
+    # three needed cells per row are kept; no DataFrame is ever built
+    wb = None
+    if file_name.lower().endswith('.csv'):
+        rows = csv.reader(io.TextIOWrapper(source, encoding='utf-8-sig', newline=''))
+    else:
+        wb = load_workbook(source, read_only=True, data_only=True)
+        rows = wb.active.iter_rows(values_only=True)
+    try:
+        header = [str(h) for h in next(rows, ())]
+        missing = [c for c in _IMPORT_COLUMNS if c not in header]
+        if missing:
+            raise ValueError(f"ستون‌های {', '.join(missing)} در فایل پیدا نشد")
+        idx = [header.index(c) for c in _IMPORT_COLUMNS]
+        for row in rows:
+            yield tuple(row[i] if i < len(row) else None for i in idx)
+    finally:
+        # read-only workbooks keep the zip archive open until closed
+        if wb is not None:
+            wb.close()
+
+def _import_scores_sync(source, file_name: str) -> int:
+    # held in memory: the code checksums are validated for the whole sheet at once
+    rows = list(read_scores_file(source, file_name))
+    codes = [persian_to_english_number(_cell_str(r[0])) for r in rows]
+    valid = valid_iranian_national_codes(codes)
+    triples = []
+    # line 1 is the header
+    for line, (code, ok, (_, subject, score)) in enumerate(zip(codes, valid, rows), start=2):
+        if not ok:
+            continue
+        # same checks as /add; the subject is kept verbatim (digits included) so
+        # /add, /remove and lookups, which don't translate it, find the same row
+        subject = _cell_str(subject).strip()
+        if not subject:
+            raise ValueError(f"ردیف {line}: نام درس خالی است")
+        try:
+            score = float(persian_to_english_number(_cell_str(score)))
+        except ValueError:
+            score = math.nan
+        if not math.isfinite(score):
+            raise ValueError(f"ردیف {line}: نمره باید عدد باشد")
+        triples.append((code, subject, score))
+    return _add_or_update_scores_many_sync(triples)
+
+async def import_scores(source, file_name: str) -> int:
+    # parsing a large workbook is seconds of CPU; keep it off the event loop too
+    return await asyncio.to_thread(_import_scores_sync, source, file_name)
 
 # ---------------- telegram helpers ----------------
-def is_admin(user_id: int) -> bool:
-    return user_id in ADMINS
+# admin commands are registered with this filter, so updates from anyone else
+# are dropped by the dispatcher before any handler coroutine runs
+ADMIN_FILTER = filters.User(user_id=ADMINS)
 
 # ---------------- command handlers ----------------
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -145,15 +447,11 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await start_cmd(update, context)
 
 async def add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text("فقط ادمین‌ها می‌توانند از این دستور استفاده کنند.")
-        return
     payload = update.message.text.partition(' ')[2].strip()
     if not payload:
         await update.message.reply_text("فرمت: /add <کدملی> <درس> <نمره>")
         return
-    parts = [p.strip() for p in SPLIT_RE.split(payload) if p.strip()]
+    parts = split_parts(payload)
     if len(parts) < 3:
         await update.message.reply_text("فرمت درست نیست. مثال: /add 0012345674 ریاضی 18")
         return
@@ -167,21 +465,19 @@ async def add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         score = float(score_s)
     except ValueError:
+        score = math.nan
+    if not math.isfinite(score):
         await update.message.reply_text("نمره باید عدد باشد (مثلاً 18 یا 17.5).")
         return
-    add_or_update_score(code, subject, score)
+    await add_or_update_score(code, subject, score)
     await update.message.reply_text(f"نمرهٔ {subject} برای {code} ثبت شد.")
 
 async def edit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await add_cmd(update, context)
 
 async def remove_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text("فقط ادمین‌ها می‌توانند از این دستور استفاده کنند.")
-        return
     payload = update.message.text.partition(' ')[2].strip()
-    parts = [p.strip() for p in SPLIT_RE.split(payload) if p.strip()]
+    parts = split_parts(payload)
     if len(parts) < 2:
         await update.message.reply_text("فرمت: /remove <کدملی> <درس>")
         return
@@ -191,86 +487,71 @@ async def remove_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not valid_iranian_national_code(code):
         await update.message.reply_text("کد ملی نامعتبر است.")
         return
-    ok = remove_score(code, subject)
+    ok = await remove_score(code, subject)
     if ok:
         await update.message.reply_text(f"نمرهٔ {subject} برای {code} حذف شد.")
     else:
         await update.message.reply_text("چنین نمره‌ای پیدا نشد.")
 
 async def remove_all_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text("فقط ادمین‌ها می‌توانند از این دستور استفاده کنند.")
-        return
     code = persian_to_english_number(update.message.text.partition(' ')[2].strip())
     if not valid_iranian_national_code(code):
         await update.message.reply_text("فرمت: /remove_all <کدملی>")
         return
-    removed = remove_all_scores(code)
+    removed = await remove_all_scores(code)
     await update.message.reply_text(f"{removed} ردیف حذف شد.")
 
 async def list_codes_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text("فقط ادمین‌ها می‌توانند از این دستور استفاده کنند.")
-        return
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT code_hmac FROM scores LIMIT 200")
-    rows = cur.fetchall()
-    conn.close()
-    text = "کدهای هش‌شده:\n" + "\n".join(r[0] for r in rows) if rows else "هیچ داده‌ای ثبت نشده."
+    rows = await list_codes()
+    text = "کدهای هش‌شده:\n" + "\n".join(r[0].hex() for r in rows) if rows else "هیچ داده‌ای ثبت نشده."
     await update.message.reply_text(text)
 
 async def import_excel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command: import scores from uploaded Excel file"""
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text("فقط ادمین‌ها می‌توانند از این دستور استفاده کنند.")
-        return
     if not update.message.document:
         await update.message.reply_text("یک فایل اکسل ارسال کنید.")
         return
-    file = await update.message.document.get_file()
-    file_path = f"/tmp/{update.message.document.file_name}"
-    await file.download_to_drive(file_path)
+    document = update.message.document
+    file = await document.get_file()
+    if document.file_size and document.file_size <= _IMPORT_MAX_IN_MEMORY:
+        buf = io.BytesIO(await file.download_as_bytearray())
+    else:
+        buf = tempfile.NamedTemporaryFile()
+        await file.download_to_memory(buf)
+        buf.seek(0)
     try:
-        df = pd.read_excel(file_path)
-        count = 0
-        for _, row in df.iterrows():
-            code = str(row['code'])
-            subject = str(row['subject'])
-            score = float(row['score'])
-            code = persian_to_english_number(code)
-            if valid_iranian_national_code(code):
-                add_or_update_score(code, subject, score)
-                count += 1
+        count = await import_scores(buf, document.file_name or "")
         await update.message.reply_text(f"{count} رکورد از فایل اکسل ثبت شد.")
     except Exception as e:
         await update.message.reply_text(f"خطا در پردازش فایل: {e}")
+    finally:
+        buf.close()
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
     if not text:
         return
-    parts = [p.strip() for p in SPLIT_RE.split(text) if p.strip()]
-    if len(parts) == 0:
-        await update.message.reply_text("لطفاً کد ملی ۱۰ رقمی یا کد ملی همراه درس را ارسال کنید.")
+    m = _MSG_RE.fullmatch(text)
+    if not m:
+        if not split_parts(text):
+            await update.message.reply_text("لطفاً کد ملی ۱۰ رقمی یا کد ملی همراه درس را ارسال کنید.")
+        else:
+            await update.message.reply_text("کد ملی نامعتبر است.")
         return
-    code = persian_to_english_number(parts[0])
-    if not valid_iranian_national_code(code):
+    code = persian_to_english_number(m.group(1))
+    if not _checksum_ok(code):
         await update.message.reply_text("کد ملی نامعتبر است.")
         return
-    if len(parts) == 1:
-        rows = lookup_scores(code)
+    subject = ' '.join(split_parts(m.group(2) or ""))
+    if not subject:
+        rows = await lookup_scores(code)
         if not rows:
             await update.message.reply_text("برای این کد ملی، نمره‌ای ثبت نشده است.")
             return
         lines = [f"{r[0].capitalize()}: {r[1]} (بروزرسانی: {r[2]})" for r in rows]
         await update.message.reply_text("\n".join(lines))
         return
-    subject = ' '.join(parts[1:])
-    row = lookup_subject(code, subject)
+    row = await lookup_subject(code, subject)
     if not row:
         await update.message.reply_text("نمرهٔ این درس برای این کد ملی ثبت نشده است.")
         return
@@ -278,24 +559,35 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---------------- main ----------------
 def main():
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise SystemExit("WEBHOOK_SECRET must be set when WEBHOOK_URL is used")
     init_db()
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    logger.info("sha256 backend: %s", sha256_backend())
+    # PTB awaits handlers one update at a time unless told otherwise; the DB calls
+    # go through to_thread precisely so other chats can be served meanwhile
+    app = (ApplicationBuilder().token(TELEGRAM_TOKEN).concurrent_updates(True)
+           .post_init(start_score_writer).post_shutdown(stop_score_writer).build())
 
     # commands
     app.add_handler(CommandHandler('start', start_cmd))
     app.add_handler(CommandHandler('help', help_cmd))
-    app.add_handler(CommandHandler('add', add_cmd))
-    app.add_handler(CommandHandler('edit', edit_cmd))
-    app.add_handler(CommandHandler('remove', remove_cmd))
-    app.add_handler(CommandHandler('remove_all', remove_all_cmd))
-    app.add_handler(CommandHandler('list_codes', list_codes_cmd))
-    app.add_handler(CommandHandler('import_excel', import_excel_cmd))
+    app.add_handler(CommandHandler('add', add_cmd, filters=ADMIN_FILTER))
+    app.add_handler(CommandHandler('edit', edit_cmd, filters=ADMIN_FILTER))
+    app.add_handler(CommandHandler('remove', remove_cmd, filters=ADMIN_FILTER))
+    app.add_handler(CommandHandler('remove_all', remove_all_cmd, filters=ADMIN_FILTER))
+    app.add_handler(CommandHandler('list_codes', list_codes_cmd, filters=ADMIN_FILTER))
+    app.add_handler(CommandHandler('import_excel', import_excel_cmd, filters=ADMIN_FILTER))
 
     # messages
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    logger.info("بات آماده است — polling اجرا می‌شود.")
-    app.run_polling()
+    if WEBHOOK_URL:
+        logger.info("بات آماده است — webhook روی پورت %s اجرا می‌شود.", PORT)
+        app.run_webhook(listen="0.0.0.0", port=PORT, url_path="telegram", webhook_url=f"{WEBHOOK_URL}/telegram",
+                        secret_token=WEBHOOK_SECRET)
+    else:
+        logger.info("بات آماده است — polling اجرا می‌شود.")
+        app.run_polling()
 
 if __name__ == '__main__':
     main()